@@ -0,0 +1,364 @@
+"""
+Admission control for the LooLocator API.
+
+Combines a per-client token bucket with per-route weighted concurrency gates.
+Requests are charged an estimated cost derived from their query parameters,
+wait in a bounded FIFO queue when a route is saturated, and are shed with a
+fast 429/503 response instead of piling up on the MongoDB connection pool.
+"""
+
+import asyncio
+import math
+from abc import ABC, abstractmethod
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Dict, FrozenSet, Tuple
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+
+# Token bucket storage
+class LimiterStore(ABC):
+    """Backend holding token bucket state, keyed by client identity"""
+
+    @abstractmethod
+    async def consume(self, key: str, rate: float, burst: float, cost: float) -> float:
+        """Take `cost` tokens from the bucket; return 0 if allowed, else seconds to wait"""
+
+
+class InMemoryLimiterStore(LimiterStore):
+    """Process-local buckets; each worker enforces its own share of the limit"""
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    async def consume(self, key: str, rate: float, burst: float, cost: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+
+        if tokens >= cost:
+            self._buckets[key] = (tokens - cost, now)
+            retry_after = 0.0
+        else:
+            self._buckets[key] = (tokens, now)
+            retry_after = (cost - tokens) / rate
+
+        if len(self._buckets) > self.max_keys:
+            self._prune(now, rate, burst)
+        return retry_after
+
+    def _prune(self, now: float, rate: float, burst: float):
+        """Drop buckets that have refilled completely; they carry no state"""
+        self._buckets = {
+            key: (tokens, updated)
+            for key, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * rate < burst
+        }
+
+
+# Atomic refill-and-take executed server side so several workers share one bucket
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+
+class RedisLimiterStore(LimiterStore):
+    """Buckets shared across workers through any Redis-compatible server"""
+
+    def __init__(self, url: str, prefix: str = "loolocator:ratelimit:"):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("RATE_LIMIT_REDIS_URL is set but the 'redis' package is not installed") from e
+
+        self.prefix = prefix
+        self._redis = redis_asyncio.from_url(url)
+        self._script = self._redis.register_script(_TOKEN_BUCKET_SCRIPT)
+
+    async def consume(self, key: str, rate: float, burst: float, cost: float) -> float:
+        result = await self._script(keys=[self.prefix + key], args=[rate, burst, cost])
+        return float(result)
+
+
+# Per-route concurrency
+class WeightedGate:
+    """Weighted semaphore with a bounded FIFO queue of waiters"""
+
+    def __init__(self, capacity: float, max_queue: int):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.in_use = 0.0
+        self._waiters = deque()
+        # Overridable per instance so tests can simulate a grant racing the deadline
+        self._wait_for = asyncio.wait_for
+
+    async def acquire(self, cost: float, timeout: float) -> bool:
+        """Reserve `cost` units; return False if the queue is full or the deadline passes"""
+        cost = min(cost, self.capacity)
+
+        if not self._waiters and self.in_use + cost <= self.capacity:
+            self.in_use += cost
+            return True
+
+        if len(self._waiters) >= self.max_queue or timeout <= 0:
+            return False
+
+        entry = (cost, asyncio.get_running_loop().create_future())
+        self._waiters.append(entry)
+        try:
+            await self._wait_for(entry[1], timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            try:
+                self._waiters.remove(entry)
+            except ValueError:
+                # Granted just as the deadline expired; hand the units back
+                self.in_use -= cost
+            self._wake()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+
+    def release(self, cost: float):
+        self.in_use -= min(cost, self.capacity)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_use + self._waiters[0][0] <= self.capacity:
+            cost, future = self._waiters.popleft()
+            if future.done():
+                continue
+            self.in_use += cost
+            future.set_result(True)
+
+
+# Cost estimates, in units of "one default nearest-washroom query"
+def _int_param(request: Request, name: str, default: int) -> int:
+    try:
+        return max(0, int(request.query_params.get(name, default)))
+    except ValueError:
+        return default
+
+
+def nearest_cost(request: Request) -> float:
+    """$geoNear work grows with the search radius and the number of documents returned"""
+    radius_km = _int_param(request, "radius", 1000) / 1000
+    limit = _int_param(request, "limit", 10)
+    return max(1.0, radius_km * max(1, limit / 10))
+
+
+def list_cost(request: Request) -> float:
+    """skip() still walks every skipped document, so deep pages are charged for them"""
+    skip = _int_param(request, "skip", 0)
+    limit = _int_param(request, "limit", 50)
+    return 1 + (skip + limit) / 100
+
+
+def gaps_cost(request: Request) -> float:
+    """Each returned cell becomes a GeoJSON polygon"""
+    return 1 + _int_param(request, "max_features", 10000) / 2000
+
+
+def tile_cost(request: Request) -> float:
+    """A map view pulls dozens of tiles at once, so each one is charged a fraction"""
+    return 0.1
+
+
+def full_scan_cost(request: Request) -> float:
+    """Jobs that scan or rebuild data for the whole collection"""
+    return 20.0
+
+
+def unit_cost(request: Request) -> float:
+    return 1.0
+
+
+@dataclass
+class RoutePolicy:
+    capacity: float
+    max_queue: int
+    max_wait: float
+    cost: Callable[[Request], float] = unit_cost
+
+
+class AdmissionController:
+    """Applies rate limits and route concurrency gates to incoming requests"""
+
+    def __init__(self, store: LimiterStore, rate: float, burst: float,
+                 policies: Dict[Tuple[str, str], RoutePolicy], default_policy: RoutePolicy,
+                 exempt_paths: Tuple[str, ...] = (), api_keys: FrozenSet[str] = frozenset()):
+        self.store = store
+        self.rate = rate
+        self.burst = burst
+        self.policies = policies
+        self.default_policy = default_policy
+        self.exempt_paths = exempt_paths
+        self.api_keys = api_keys
+        self._gates: Dict[Tuple[str, str], WeightedGate] = {}
+
+    def client_key(self, request: Request) -> str:
+        """Bucket per configured API key; anything else (including unknown keys) is keyed on the client IP"""
+        api_key = request.headers.get("x-api-key")
+        if api_key and api_key in self.api_keys:
+            return f"key:{api_key}"
+        # Behind a proxy listed in FORWARDED_ALLOW_IPS, uvicorn has already replaced this with the
+        # address from X-Forwarded-For
+        return f"ip:{request.client.host if request.client else 'unknown'}"
+
+    def route_for(self, request: Request) -> Tuple[Tuple[str, str], RoutePolicy]:
+        """Exact (method, path) match first, then policies whose path ends in '/*' by prefix"""
+        method, path = request.method, request.url.path.rstrip("/")
+        if (method, path) in self.policies:
+            return (method, path), self.policies[(method, path)]
+        for route, policy in self.policies.items():
+            if route[0] == method and route[1].endswith("/*") and path.startswith(route[1][:-1]):
+                return route, policy
+        return ("*", "*"), self.default_policy
+
+    def gate_for(self, route: Tuple[str, str], policy: RoutePolicy) -> WeightedGate:
+        gate = self._gates.get(route)
+        if gate is None:
+            gate = self._gates[route] = WeightedGate(policy.capacity, policy.max_queue)
+        return gate
+
+    def request_deadline(self, request: Request, policy: RoutePolicy) -> float:
+        """Queueing budget in seconds, shortened by an optional client X-Request-Timeout-Ms"""
+        header = request.headers.get("x-request-timeout-ms")
+        if header:
+            try:
+                return min(policy.max_wait, max(0.0, float(header) / 1000))
+            except ValueError:
+                pass
+        return policy.max_wait
+
+    async def __call__(self, request: Request, call_next):
+        if not request.url.path.startswith("/api/") or request.url.path in self.exempt_paths:
+            return await call_next(request)
+
+        route, policy = self.route_for(request)
+        # The bucket is charged the full estimate; the gate clamps it to the route's capacity
+        cost = policy.cost(request)
+
+        try:
+            retry_after = await self.store.consume(self.client_key(request), self.rate, self.burst,
+                                                   min(cost, self.burst))
+        except Exception as e:
+            # A shared limiter outage should not take the API down with it
+            print(f"Rate limiter error (allowing request): {e}")
+            retry_after = 0.0
+        if retry_after > 0:
+            return _shed(429, "Rate limit exceeded", retry_after)
+
+        gate = self.gate_for(route, policy)
+        if not await gate.acquire(cost, self.request_deadline(request, policy)):
+            return _shed(503, "Server busy, please retry", policy.max_wait)
+
+        try:
+            return await call_next(request)
+        finally:
+            gate.release(cost)
+
+
+def _shed(status_code: int, detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": detail},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def create_admission_controller() -> AdmissionController:
+    """Build the controller from environment configuration"""
+    redis_url = os.getenv("RATE_LIMIT_REDIS_URL")
+    store = RedisLimiterStore(redis_url) if redis_url else InMemoryLimiterStore()
+
+    max_wait = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "2.0"))
+    policies = {
+        ("GET", "/api/washrooms/nearest"): RoutePolicy(
+            capacity=float(os.getenv("NEAREST_CONCURRENCY", "32")),
+            max_queue=int(os.getenv("NEAREST_MAX_QUEUE", "64")),
+            max_wait=max_wait,
+            cost=nearest_cost,
+        ),
+        ("GET", "/api/washrooms"): RoutePolicy(
+            capacity=float(os.getenv("LIST_CONCURRENCY", "16")),
+            max_queue=int(os.getenv("LIST_MAX_QUEUE", "32")),
+            max_wait=max_wait,
+            cost=list_cost,
+        ),
+        ("POST", "/api/washrooms"): RoutePolicy(
+            capacity=float(os.getenv("WRITE_CONCURRENCY", "8")),
+            max_queue=int(os.getenv("WRITE_MAX_QUEUE", "16")),
+            max_wait=max_wait,
+        ),
+        ("GET", "/api/analytics/coverage"): RoutePolicy(
+            capacity=float(os.getenv("COVERAGE_CONCURRENCY", "8")),
+            max_queue=int(os.getenv("COVERAGE_MAX_QUEUE", "16")),
+            max_wait=max_wait,
+        ),
+        ("GET", "/api/analytics/coverage/gaps"): RoutePolicy(
+            capacity=float(os.getenv("COVERAGE_GAPS_CONCURRENCY", "8")),
+            max_queue=int(os.getenv("COVERAGE_GAPS_MAX_QUEUE", "16")),
+            max_wait=max_wait,
+            cost=gaps_cost,
+        ),
+        ("GET", "/api/analytics/coverage/tiles/*"): RoutePolicy(
+            capacity=float(os.getenv("COVERAGE_TILES_CONCURRENCY", "4")),
+            max_queue=int(os.getenv("COVERAGE_TILES_MAX_QUEUE", "256")),
+            max_wait=max_wait,
+            cost=tile_cost,
+        ),
+        # Only one full recompute at a time, and none queued behind it
+        ("POST", "/api/analytics/coverage/recompute"): RoutePolicy(
+            capacity=1,
+            max_queue=0,
+            max_wait=0,
+            cost=full_scan_cost,
+        ),
+        ("POST", "/api/washrooms/deduplicate"): RoutePolicy(
+            capacity=1,
+            max_queue=0,
+            max_wait=0,
+            cost=full_scan_cost,
+        ),
+    }
+    default_policy = RoutePolicy(
+        capacity=float(os.getenv("DEFAULT_CONCURRENCY", "64")),
+        max_queue=int(os.getenv("DEFAULT_MAX_QUEUE", "128")),
+        max_wait=max_wait,
+    )
+
+    return AdmissionController(
+        store=store,
+        rate=float(os.getenv("RATE_LIMIT_PER_SECOND", "10")),
+        burst=float(os.getenv("RATE_LIMIT_BURST", "40")),
+        policies=policies,
+        default_policy=default_policy,
+        exempt_paths=("/api/health",),
+        api_keys=frozenset(key.strip() for key in os.getenv("API_KEYS", "").split(",") if key.strip()),
+    )
@@ -0,0 +1,426 @@
+"""
+Precomputed service coverage for the LooLocator API.
+
+Lays a regular grid (in metres, on a local equirectangular projection) over
+the service area and stores, for every filter combination, the distance from
+each cell centre to the nearest matching washroom. Distances are computed in
+one pass per layer with a KD-tree, kept as uint16 arrays, and patched in place
+when a new washroom is inserted. Layers are persisted in bands of rows so an
+insert only rewrites the bands it changed.
+"""
+
+import asyncio
+import itertools
+import math
+import os
+import struct
+import uuid
+import zlib
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pymongo import ReplaceOne
+from scipy.spatial import cKDTree
+
+
+# Filters a layer can be restricted to, and how each one matches a stored washroom
+FILTERS = {
+    "accessible": lambda washroom: bool(washroom.get("accessibility")),
+    "verified": lambda washroom: bool(washroom.get("verified")),
+    "open_24h": lambda washroom: washroom.get("hours") == "24/7",
+}
+
+# Distances saturate here; also used for "no matching washroom at all"
+MAX_DISTANCE = np.iinfo(np.uint16).max
+MAX_CELLS = 500_000
+METRES_PER_DEGREE = 111_320.0
+TILE_SIZE = 256
+BAND_ROWS = 64
+
+
+def layer_key(filters: List[str]) -> str:
+    """Canonical name for a filter combination, e.g. 'accessible+verified' ('all' if none)"""
+    return "+".join(name for name in FILTERS if name in filters) or "all"
+
+
+def layer_filters(key: str) -> List[str]:
+    return [] if key == "all" else key.split("+")
+
+
+def all_layer_keys() -> List[str]:
+    return [
+        layer_key(list(combo))
+        for size in range(len(FILTERS) + 1)
+        for combo in itertools.combinations(FILTERS, size)
+    ]
+
+
+@dataclass
+class CoverageGrid:
+    """Regular grid of `cell_size` metre cells anchored at its south-west corner"""
+    min_lat: float
+    min_lng: float
+    rows: int
+    cols: int
+    cell_size: float
+    ref_lat: float
+
+    @classmethod
+    def from_bounds(cls, min_lat: float, min_lng: float, max_lat: float, max_lng: float,
+                    cell_size: float) -> "CoverageGrid":
+        ref_lat = (min_lat + max_lat) / 2
+        height = (max_lat - min_lat) * METRES_PER_DEGREE
+        width = (max_lng - min_lng) * METRES_PER_DEGREE * math.cos(math.radians(ref_lat))
+        rows = max(1, math.ceil(height / cell_size))
+        cols = max(1, math.ceil(width / cell_size))
+        if rows * cols > MAX_CELLS:
+            raise ValueError(f"Coverage grid of {rows}x{cols} cells exceeds {MAX_CELLS}; increase the cell size")
+        return cls(float(min_lat), float(min_lng), rows, cols, float(cell_size), float(ref_lat))
+
+    @property
+    def lat_step(self) -> float:
+        return self.cell_size / METRES_PER_DEGREE
+
+    @property
+    def lng_step(self) -> float:
+        return self.cell_size / (METRES_PER_DEGREE * math.cos(math.radians(self.ref_lat)))
+
+    def project(self, lat, lng) -> Tuple[np.ndarray, np.ndarray]:
+        """Convert degrees to (x, y) metres from the grid origin"""
+        x = (np.asarray(lng) - self.min_lng) / self.lng_step * self.cell_size
+        y = (np.asarray(lat) - self.min_lat) / self.lat_step * self.cell_size
+        return x, y
+
+    def cell_centres(self, rows: slice = slice(None), cols: slice = slice(None)) -> Tuple[np.ndarray, np.ndarray]:
+        """(x, y) metre coordinates of the centres of the selected block of cells"""
+        row_ids = np.arange(self.rows)[rows]
+        col_ids = np.arange(self.cols)[cols]
+        y, x = np.meshgrid((row_ids + 0.5) * self.cell_size, (col_ids + 0.5) * self.cell_size, indexing="ij")
+        return x, y
+
+    def cell_index(self, lat, lng) -> Tuple[np.ndarray, np.ndarray]:
+        """Row and column of the cell containing each point (may fall outside the grid)"""
+        row = np.floor((np.asarray(lat) - self.min_lat) / self.lat_step).astype(np.int64)
+        col = np.floor((np.asarray(lng) - self.min_lng) / self.lng_step).astype(np.int64)
+        return row, col
+
+    def cell_bounds(self, row: int, col: int) -> Tuple[float, float, float, float]:
+        south = self.min_lat + row * self.lat_step
+        west = self.min_lng + col * self.lng_step
+        return south, west, south + self.lat_step, west + self.lng_step
+
+
+def washroom_points(washrooms: List[dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """Latitudes and longitudes of stored (GeoJSON) washroom documents"""
+    coordinates = np.array([w["location"]["coordinates"] for w in washrooms], dtype=np.float64).reshape(-1, 2)
+    return coordinates[:, 1], coordinates[:, 0]
+
+
+def nearest_distances(grid: CoverageGrid, lat: np.ndarray, lng: np.ndarray) -> np.ndarray:
+    """Distance in metres from every cell centre to the nearest of the given points"""
+    if len(lat) == 0:
+        return np.full((grid.rows, grid.cols), MAX_DISTANCE, dtype=np.uint16)
+
+    x, y = grid.project(lat, lng)
+    tree = cKDTree(np.column_stack([x, y]))
+    cell_x, cell_y = grid.cell_centres()
+    distances, _ = tree.query(np.column_stack([cell_x.ravel(), cell_y.ravel()]), k=1,
+                              distance_upper_bound=MAX_DISTANCE)
+    return _to_uint16(distances).reshape(grid.rows, grid.cols)
+
+
+def _to_uint16(distances: np.ndarray) -> np.ndarray:
+    return np.minimum(np.round(distances), MAX_DISTANCE).astype(np.uint16)
+
+
+def build_layers(grid: CoverageGrid, washrooms: List[dict]) -> Dict[str, np.ndarray]:
+    """Compute the distance array for every filter combination"""
+    lat, lng = washroom_points(washrooms)
+    matches = {
+        name: np.array([match(w) for w in washrooms], dtype=bool)
+        for name, match in FILTERS.items()
+    }
+
+    layers = {}
+    for key in all_layer_keys():
+        mask = np.ones(len(washrooms), dtype=bool)
+        for name in layer_filters(key):
+            mask &= matches[name]
+        layers[key] = nearest_distances(grid, lat[mask], lng[mask])
+    return layers
+
+
+def apply_insert(grid: CoverageGrid, layer: np.ndarray, lat: float, lng: float) -> Optional[Tuple[int, int]]:
+    """Lower distances in place for cells now closer to a new washroom; return the changed row span.
+
+    A cell can only improve if the new point is nearer than its current value,
+    so only the block within the layer's current maximum distance is examined.
+    """
+    reach = float(layer.max())
+    if reach == 0:
+        return None
+
+    x, y = grid.project(lat, lng)
+    row_lo = max(0, math.floor((y - reach) / grid.cell_size))
+    row_hi = min(grid.rows, math.ceil((y + reach) / grid.cell_size))
+    col_lo = max(0, math.floor((x - reach) / grid.cell_size))
+    col_hi = min(grid.cols, math.ceil((x + reach) / grid.cell_size))
+    if row_lo >= row_hi or col_lo >= col_hi:
+        return None
+
+    rows, cols = slice(row_lo, row_hi), slice(col_lo, col_hi)
+    cell_x, cell_y = grid.cell_centres(rows, cols)
+    candidate = _to_uint16(np.hypot(cell_x - x, cell_y - y))
+    block = layer[rows, cols]
+    improved = candidate < block
+    block[improved] = candidate[improved]
+
+    changed_rows = np.nonzero(improved.any(axis=1))[0]
+    if len(changed_rows) == 0:
+        return None
+    return row_lo + int(changed_rows[0]), row_lo + int(changed_rows[-1]) + 1
+
+
+def render_tile(grid: CoverageGrid, layer: np.ndarray, z: int, x: int, y: int, max_distance: float) -> bytes:
+    """Render a Web Mercator z/x/y heatmap tile as PNG (green = close, red = max_distance or more)"""
+    n = 2 ** z
+    offsets = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    lng = (x + offsets) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+    lat, lng = np.meshgrid(lat, lng, indexing="ij")
+
+    row, col = grid.cell_index(lat, lng)
+    inside = (row >= 0) & (row < grid.rows) & (col >= 0) & (col < grid.cols)
+    distances = np.zeros(lat.shape, dtype=np.float64)
+    distances[inside] = layer[row[inside], col[inside]]
+
+    t = np.clip(distances / max_distance, 0.0, 1.0)
+    rgba = np.zeros(lat.shape + (4,), dtype=np.uint8)
+    rgba[..., 0] = np.round(255 * t)
+    rgba[..., 1] = np.round(255 * (1 - t))
+    rgba[..., 3] = np.where(inside, 160, 0)
+    return _encode_png(rgba)
+
+
+def _encode_png(rgba: np.ndarray) -> bytes:
+    height, width = rgba.shape[:2]
+    # Prefix each scanline with filter type 0 (None)
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) + chunk(b"IEND", b""))
+
+
+def gap_features(grid: CoverageGrid, layer: np.ndarray, min_distance: float, max_features: int) -> dict:
+    """GeoJSON FeatureCollection of cells at least `min_distance` metres from a washroom"""
+    rows, cols = np.nonzero(layer >= min_distance)
+    if len(rows) > max_features:
+        raise ValueError(f"{len(rows)} cells match; raise min_distance or use heatmap tiles")
+
+    features = []
+    for row, col in zip(rows.tolist(), cols.tolist()):
+        south, west, north, east = grid.cell_bounds(row, col)
+        distance = int(layer[row, col])
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]],
+            },
+            "properties": {"distance": None if distance == MAX_DISTANCE else distance},
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+class CoverageStore:
+    """Holds the current coverage layers and persists them to MongoDB.
+
+    A metadata document (_id "coverage") records the grid, the configuration it
+    was built from and the current generation; layer data lives in one
+    document per band of BAND_ROWS rows, tagged with that generation.
+
+    Several workers may share the collection. Inserts only ever lower distances,
+    so each patched band is merged with the stored one by element-wise minimum
+    and written back with a compare-and-set on the band's version. Writes for a
+    generation that another worker has since replaced are dropped, and the
+    worker reloads the current one instead.
+    """
+
+    def __init__(self, washrooms_collection, coverage_collection):
+        self.washrooms_collection = washrooms_collection
+        self.coverage_collection = coverage_collection
+        self.grid: Optional[CoverageGrid] = None
+        self.layers: Dict[str, np.ndarray] = {}
+        self.computed_at: Optional[datetime] = None
+        self.generation: Optional[str] = None
+        self._lock = asyncio.Lock()
+
+    async def load_or_build(self):
+        """Load stored layers, recomputing them if missing or built from a different configuration"""
+        meta = await self.coverage_collection.find_one({"_id": "coverage"})
+        if meta is None or meta.get("config") != self._config():
+            await self.rebuild()
+            return
+
+        grid = CoverageGrid(**meta["grid"])
+        layers = {key: np.empty((grid.rows, grid.cols), dtype=np.uint16) for key in all_layer_keys()}
+        bands_per_layer = math.ceil(grid.rows / BAND_ROWS)
+        loaded = 0
+        async for band in self.coverage_collection.find({"generation": meta["current_generation"]}):
+            if band["layer"] in layers:
+                start = band["band"] * BAND_ROWS
+                rows = np.frombuffer(band["data"], dtype=np.uint16).reshape(-1, grid.cols)
+                layers[band["layer"]][start:start + len(rows)] = rows
+                loaded += 1
+
+        if loaded != len(layers) * bands_per_layer:
+            print("Stored coverage is incomplete; recomputing")
+            await self.rebuild()
+            return
+
+        self.grid, self.layers = grid, layers
+        self.computed_at, self.generation = meta["computed_at"], meta["current_generation"]
+
+    async def rebuild(self):
+        """Recompute every layer from the full washroom collection"""
+        async with self._lock:
+            # Flagged duplicates are hidden from search, so they must not close coverage gaps either
+            washrooms = await self.washrooms_collection.find(
+                {"duplicate_of": None}, {"_id": 0, "location": 1, "accessibility": 1, "verified": 1, "hours": 1}
+            ).to_list(length=None)
+
+            grid = self._configured_grid(washrooms)
+            loop = asyncio.get_running_loop()
+            layers = await loop.run_in_executor(None, build_layers, grid, washrooms)
+
+            # Write the new generation in full before switching the metadata over to it
+            generation = uuid.uuid4().hex
+            self.grid, self.layers = grid, layers
+            self.computed_at, self.generation = datetime.utcnow(), generation
+            await self._save_bands()
+            previous = await self._save_meta()
+            if previous and previous.get("current_generation") not in (None, generation):
+                await self.coverage_collection.delete_many({"generation": previous["current_generation"]})
+
+    async def apply_insert(self, washroom: dict) -> Dict[str, Tuple[int, int]]:
+        """Patch the layers whose filters the new washroom satisfies; return changed row spans"""
+        if self.grid is None or washroom.get("duplicate_of"):
+            return {}
+
+        changed, current = await self._apply_and_merge(washroom)
+        if not current:
+            # Another worker rebuilt coverage; load its generation and patch that instead
+            await self.load_or_build()
+            changed, _ = await self._apply_and_merge(washroom)
+        return changed
+
+    async def _apply_and_merge(self, washroom: dict) -> Tuple[Dict[str, Tuple[int, int]], bool]:
+        """Patch in memory and merge changed bands into storage; False if our generation is stale"""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            changed = await loop.run_in_executor(None, self._patch, washroom)
+            if not changed:
+                return changed, True
+
+            for key, (row_lo, row_hi) in changed.items():
+                for band in range(row_lo // BAND_ROWS, math.ceil(row_hi / BAND_ROWS)):
+                    if not await self._merge_band(key, band):
+                        return changed, False
+
+            self.computed_at = datetime.utcnow()
+            result = await self.coverage_collection.update_one(
+                {"_id": "coverage", "current_generation": self.generation},
+                {"$set": {"computed_at": self.computed_at}},
+            )
+            return changed, result.matched_count == 1
+
+    def layer(self, filters: List[str]) -> np.ndarray:
+        return self.layers[layer_key(filters)]
+
+    def _patch(self, washroom: dict) -> Dict[str, Tuple[int, int]]:
+        lng, lat = washroom["location"]["coordinates"]
+        changed = {}
+        for key, layer in self.layers.items():
+            if all(FILTERS[name](washroom) for name in layer_filters(key)):
+                span = apply_insert(self.grid, layer, lat, lng)
+                if span:
+                    changed[key] = span
+        return changed
+
+    def _config(self) -> dict:
+        """Settings the stored grid depends on; a mismatch on startup forces a rebuild"""
+        return {
+            "bbox": os.getenv("COVERAGE_BBOX"),
+            "cell_size": float(os.getenv("COVERAGE_CELL_METRES", "100")),
+            "padding": float(os.getenv("COVERAGE_PADDING_METRES", "2000")),
+            "layers": all_layer_keys(),
+            "band_rows": BAND_ROWS,
+        }
+
+    def _configured_grid(self, washrooms: List[dict]) -> CoverageGrid:
+        """Grid from COVERAGE_BBOX, or the washrooms' extent padded by COVERAGE_PADDING_METRES"""
+        config = self._config()
+        if config["bbox"]:
+            min_lat, min_lng, max_lat, max_lng = (float(v) for v in config["bbox"].split(","))
+            return CoverageGrid.from_bounds(min_lat, min_lng, max_lat, max_lng, config["cell_size"])
+
+        if not washrooms:
+            raise ValueError("No washrooms to derive a coverage grid from; set COVERAGE_BBOX")
+
+        lat, lng = washroom_points(washrooms)
+        pad_lat = config["padding"] / METRES_PER_DEGREE
+        pad_lng = config["padding"] / (METRES_PER_DEGREE * math.cos(math.radians(float(lat.mean()))))
+        return CoverageGrid.from_bounds(lat.min() - pad_lat, lng.min() - pad_lng,
+                                        lat.max() + pad_lat, lng.max() + pad_lng, config["cell_size"])
+
+    async def _save_bands(self):
+        """Write every band of a freshly built generation"""
+        requests = []
+        for key, layer in self.layers.items():
+            for band in range(math.ceil(self.grid.rows / BAND_ROWS)):
+                rows = layer[band * BAND_ROWS:(band + 1) * BAND_ROWS]
+                requests.append(ReplaceOne(
+                    {"_id": f"{self.generation}:{key}:{band}"},
+                    {"generation": self.generation, "layer": key, "band": band, "version": 0, "data": rows.tobytes()},
+                    upsert=True,
+                ))
+        await self.coverage_collection.bulk_write(requests, ordered=False)
+
+    async def _merge_band(self, key: str, band: int, attempts: int = 5) -> bool:
+        """Fold our copy of a band into the stored one; False if the band's generation is gone"""
+        band_id = f"{self.generation}:{key}:{band}"
+        rows = slice(band * BAND_ROWS, (band + 1) * BAND_ROWS)
+        for _ in range(attempts):
+            stored = await self.coverage_collection.find_one({"_id": band_id})
+            if stored is None:
+                return False
+            local = self.layers[key][rows]
+            merged = np.minimum(local, np.frombuffer(stored["data"], dtype=np.uint16).reshape(local.shape))
+            result = await self.coverage_collection.update_one(
+                {"_id": band_id, "version": stored["version"]},
+                {"$set": {"data": merged.tobytes()}, "$inc": {"version": 1}},
+            )
+            if result.matched_count == 1:
+                # Pick up whatever other workers had already merged
+                self.layers[key][rows] = merged
+                return True
+        raise RuntimeError(f"Coverage band {band_id} kept changing; giving up after {attempts} attempts")
+
+    async def _save_meta(self) -> Optional[dict]:
+        """Point the metadata at our generation; returns the metadata it replaced"""
+        return await self.coverage_collection.find_one_and_replace(
+            {"_id": "coverage"},
+            {
+                "grid": asdict(self.grid),
+                "config": self._config(),
+                "current_generation": self.generation,
+                "computed_at": self.computed_at,
+            },
+            upsert=True,
+        )
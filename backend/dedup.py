@@ -0,0 +1,319 @@
+"""
+Near-duplicate detection for crowd-sourced washroom submissions.
+
+Candidates are washrooms within a few metres of each other (found through the
+2dsphere index on write, or a KD-tree spatial join in the batch job), scored on
+character-trigram similarity of their normalized names and addresses. Likely
+duplicates above DEDUP_MERGE_SCORE are merged into one record; weaker matches
+above DEDUP_FLAG_SCORE are kept but flagged with `duplicate_of`.
+
+Batch merges are soft: a merged record keeps its document but gets `merged_into`
+(and `duplicate_of`) set to the record that absorbed it, so it disappears from
+search and coverage and a bad merge can be undone.
+
+Merges only fill in descriptive fields. Trust flags are never upgraded by a
+submission: `verified` is left alone and a claimed `accessibility` is counted
+in `accessibility_reports` rather than set.
+"""
+
+import asyncio
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+from pymongo import UpdateOne
+from scipy.spatial import cKDTree
+
+
+EARTH_RADIUS_METRES = 6_371_008.8
+DEDUP_MAX_CANDIDATES = 20
+
+# Words every submission tends to include; they say nothing about which facility it is
+GENERIC_WORDS = {
+    "the", "public", "restroom", "restrooms", "washroom", "washrooms", "toilet", "toilets",
+    "bathroom", "bathrooms", "wc", "loo", "facility", "facilities",
+}
+
+
+# Settings are read at call time so values loaded from .env after import apply
+def dedup_radius() -> float:
+    return float(os.getenv("DEDUP_RADIUS_METRES", "25"))
+
+
+def flag_score() -> float:
+    return float(os.getenv("DEDUP_FLAG_SCORE", "0.5"))
+
+
+def merge_score() -> float:
+    return float(os.getenv("DEDUP_MERGE_SCORE", "0.8"))
+
+
+def normalize(text: Optional[str]) -> str:
+    words = re.sub(r"[^a-z0-9]+", " ", (text or "").lower()).split()
+    return " ".join(word for word in words if word not in GENERIC_WORDS)
+
+
+def trigrams(text: str) -> FrozenSet[str]:
+    if not text:
+        return frozenset()
+    padded = f"  {text} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+@dataclass(frozen=True)
+class TextSignature:
+    """Precomputed trigram sets used to compare two submissions cheaply"""
+    name: FrozenSet[str]
+    address: FrozenSet[str]
+
+    @classmethod
+    def of(cls, washroom: dict) -> "TextSignature":
+        return cls(trigrams(normalize(washroom.get("name"))), trigrams(normalize(washroom.get("address"))))
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> Optional[float]:
+    """Trigram Jaccard similarity, or None when either side has nothing to compare"""
+    if not a or not b:
+        return None
+    return len(a & b) / len(a | b)
+
+
+def similarity(a: TextSignature, b: TextSignature) -> float:
+    """Weighted name/address similarity in [0, 1]; names count for more than addresses"""
+    name = jaccard(a.name, b.name)
+    address = jaccard(a.address, b.address)
+    if name is None and address is None:
+        return 0.0
+    if name is None:
+        return address
+    if address is None:
+        return name
+    return 0.7 * name + 0.3 * address
+
+
+def merge_updates(washroom_id: str, incoming: dict, accessibility_claimed: bool = False) -> List[UpdateOne]:
+    """Writes that fold `incoming` into the stored washroom without reading it first
+
+    Amenities are added with $addToSet and descriptive fields are only set while
+    still empty, so concurrent merges into the same record cannot undo each other.
+    """
+    updates = []
+
+    change = {}
+    if incoming.get("amenities"):
+        change["$addToSet"] = {"amenities": {"$each": list(incoming["amenities"])}}
+    if accessibility_claimed:
+        change["$inc"] = {"accessibility_reports": 1}
+    if change:
+        updates.append(UpdateOne({"id": washroom_id}, change))
+
+    for key in ("description", "hours"):
+        if incoming.get(key):
+            updates.append(UpdateOne({"id": washroom_id, key: {"$in": [None, ""]}}, {"$set": {key: incoming[key]}}))
+
+    return updates
+
+
+def claims_accessibility(existing: dict, incoming: dict) -> bool:
+    """Whether `incoming` reports accessibility `existing` does not have; counted, never applied"""
+    return bool(incoming.get("accessibility")) and not existing.get("accessibility")
+
+
+# Write-time check
+@dataclass
+class DuplicateMatch:
+    washroom: dict
+    score: float
+    distance: float
+
+
+async def find_duplicate(washrooms_collection, washroom_data: dict) -> Optional[DuplicateMatch]:
+    """Best-scoring existing washroom within DEDUP_RADIUS_METRES, if it scores at least DEDUP_FLAG_SCORE"""
+    threshold = flag_score()
+    pipeline = [
+        {
+            "$geoNear": {
+                "near": washroom_data["location"],
+                "distanceField": "distance",
+                "maxDistance": dedup_radius(),
+                "query": {"duplicate_of": None},
+                "spherical": True
+            }
+        },
+        {"$limit": DEDUP_MAX_CANDIDATES}
+    ]
+    candidates = await washrooms_collection.aggregate(pipeline).to_list(length=DEDUP_MAX_CANDIDATES)
+
+    incoming = TextSignature.of(washroom_data)
+    best = None
+    for candidate in candidates:
+        score = similarity(incoming, TextSignature.of(candidate))
+        if score >= threshold and (best is None or score > best.score):
+            best = DuplicateMatch(candidate, score, candidate["distance"])
+    return best
+
+
+# Batch job
+@dataclass
+class DedupPlan:
+    merges: List[dict] = field(default_factory=list)
+    flags: List[dict] = field(default_factory=list)
+    repoints: List[dict] = field(default_factory=list)
+
+
+def _unit_vectors(washrooms: List[dict]) -> np.ndarray:
+    """Points on a sphere of Earth's radius; chord length matches ground distance at these scales"""
+    coordinates = np.radians(np.array([w["location"]["coordinates"] for w in washrooms], dtype=np.float64).reshape(-1, 2))
+    lng, lat = coordinates[:, 0], coordinates[:, 1]
+    return EARTH_RADIUS_METRES * np.column_stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)])
+
+
+def _canonical_order(washroom: dict):
+    """Unflagged records win, then verified ones, then the oldest submission"""
+    return (
+        bool(washroom.get("duplicate_of")),
+        not washroom.get("verified"),
+        washroom.get("created_at") or datetime.max,
+        washroom["id"],
+    )
+
+
+def plan_deduplication(washrooms: List[dict], radius: Optional[float] = None) -> DedupPlan:
+    """Group likely duplicates using a spatial join instead of comparing every pair
+
+    Strong matches are chained into candidate groups, but a member is only merged
+    if it also matches the group's canonical record directly; members that were
+    only linked through others are considered for a flag against it instead.
+    """
+    plan = DedupPlan()
+    if len(washrooms) < 2:
+        return plan
+
+    radius = dedup_radius() if radius is None else radius
+    merge_threshold, flag_threshold = merge_score(), flag_score()
+
+    points = _unit_vectors(washrooms)
+    tree = cKDTree(points)
+    pairs = tree.query_pairs(radius, output_type="ndarray")
+    signatures = [TextSignature.of(w) for w in washrooms]
+
+    parent = list(range(len(washrooms)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    weak = []
+    for i, j in pairs.tolist():
+        score = similarity(signatures[i], signatures[j])
+        if score >= merge_threshold:
+            parent[find(i)] = find(j)
+        elif score >= flag_threshold:
+            weak.append((i, j, score))
+
+    groups: Dict[int, List[int]] = {}
+    for i in range(len(washrooms)):
+        groups.setdefault(find(i), []).append(i)
+
+    canonical_of = {i: i for i in range(len(washrooms))}
+    survivor: Dict[str, str] = {w["id"]: w["id"] for w in washrooms}
+    for members in groups.values():
+        if len(members) < 2:
+            continue
+        members.sort(key=lambda i: _canonical_order(washrooms[i]))
+        canonical, duplicates = members[0], []
+        for i in members[1:]:
+            score = similarity(signatures[canonical], signatures[i])
+            near = np.linalg.norm(points[canonical] - points[i]) <= radius
+            if near and score >= merge_threshold:
+                duplicates.append(i)
+                canonical_of[i] = canonical
+                survivor[washrooms[i]["id"]] = washrooms[canonical]["id"]
+            elif score >= flag_threshold:
+                weak.append((canonical, i, score))
+        if duplicates:
+            plan.merges.append({
+                "canonical": washrooms[canonical]["id"],
+                "duplicates": [washrooms[i]["id"] for i in duplicates]
+            })
+
+    # Existing flags must not point at records merged away; a flag that now points
+    # at the record itself (its original was merged into it) is cleared
+    for i, washroom in enumerate(washrooms):
+        target = washroom.get("duplicate_of")
+        if not target or canonical_of[i] != i or target not in survivor:
+            continue
+        new_target = survivor[target]
+        if new_target == washroom["id"]:
+            plan.repoints.append({"id": washroom["id"], "duplicate_of": None})
+        elif new_target != target:
+            plan.repoints.append({"id": washroom["id"], "duplicate_of": new_target})
+
+    flagged = set()
+    for i, j, score in sorted(weak, key=lambda pair: -pair[2]):
+        i, j = canonical_of[i], canonical_of[j]
+        if i == j:
+            continue
+        keep, flag = sorted((i, j), key=lambda k: _canonical_order(washrooms[k]))
+        if flag in flagged or washrooms[flag].get("duplicate_of"):
+            continue
+        flagged.add(flag)
+        plan.flags.append({
+            "id": washrooms[flag]["id"],
+            "duplicate_of": washrooms[keep]["id"],
+            "score": round(score, 3)
+        })
+
+    return plan
+
+
+async def run_deduplication(washrooms_collection, dry_run: bool = True) -> Tuple[DedupPlan, int]:
+    """Plan (and unless dry_run, apply) merges and flags; return the plan and records merged"""
+    washrooms = await washrooms_collection.find({"merged_into": None}, {"_id": 0}).to_list(length=None)
+
+    loop = asyncio.get_running_loop()
+    plan = await loop.run_in_executor(None, plan_deduplication, washrooms)
+    if dry_run:
+        return plan, 0
+
+    by_id = {w["id"]: w for w in washrooms}
+    merged = 0
+    for merge in plan.merges:
+        canonical = by_id[merge["canonical"]]
+        # Ordered, so the preferred duplicate fills an empty field first
+        updates = []
+        for duplicate_id in merge["duplicates"]:
+            duplicate = by_id[duplicate_id]
+            updates += merge_updates(canonical["id"], duplicate, claims_accessibility(canonical, duplicate))
+        if updates:
+            await washrooms_collection.bulk_write(updates, ordered=True)
+        result = await washrooms_collection.update_many(
+            {"id": {"$in": merge["duplicates"]}, "merged_into": None},
+            {"$set": {"merged_into": canonical["id"], "duplicate_of": canonical["id"]}}
+        )
+        merged += result.modified_count
+        # Records merged in earlier runs follow their canonical record
+        await washrooms_collection.update_many(
+            {"merged_into": {"$in": merge["duplicates"]}},
+            {"$set": {"merged_into": canonical["id"], "duplicate_of": canonical["id"]}}
+        )
+
+    for repoint in plan.repoints:
+        if repoint["duplicate_of"]:
+            update = {"$set": {"duplicate_of": repoint["duplicate_of"]}}
+        else:
+            update = {"$set": {"duplicate_of": None}, "$unset": {"duplicate_score": ""}}
+        await washrooms_collection.update_one({"id": repoint["id"]}, update)
+
+    for flag in plan.flags:
+        await washrooms_collection.update_one(
+            {"id": flag["id"]},
+            {"$set": {"duplicate_of": flag["duplicate_of"], "duplicate_score": flag["score"]}}
+        )
+
+    return plan, merged
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, Header, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pymongo import MongoClient, GEOSPHERE
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -10,11 +10,19 @@ from geopy.distance import geodesic
 import asyncio
 from datetime import datetime
 import uuid
+import secrets
+
+from admission import create_admission_controller
+from coverage_analytics import CoverageStore, gap_features, render_tile
+from dedup import claims_accessibility, find_duplicate, merge_score, merge_updates, run_deduplication
 
 load_dotenv()
 
 app = FastAPI(title="LooLocator API", description="Find nearest washrooms/restrooms")
 
+# Admission control (registered before CORS so shed responses still carry CORS headers)
+app.middleware("http")(create_admission_controller())
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -31,6 +39,9 @@ DATABASE_NAME = os.getenv("DATABASE_NAME", "loolocator_db")
 client = AsyncIOMotorClient(MONGO_URL)
 db = client[DATABASE_NAME]
 washrooms_collection = db.washrooms
+coverage_collection = db.coverage
+
+coverage_store = CoverageStore(washrooms_collection, coverage_collection)
 
 # Pydantic models
 class Location(BaseModel):
@@ -48,6 +59,8 @@ class Washroom(BaseModel):
     rating: float = 0.0
     hours: Optional[str] = "24/7"
     verified: bool = False
+    duplicate_of: Optional[str] = None
+    merged_into: Optional[str] = None
     created_at: Optional[datetime] = None
 
 class WashroomResponse(Washroom):
@@ -76,6 +89,13 @@ async def startup_db():
     count = await washrooms_collection.count_documents({})
     if count == 0:
         await seed_washroom_data()
+    
+    # Load (or compute) coverage analytics
+    try:
+        await coverage_store.load_or_build()
+        print("Coverage analytics ready")
+    except Exception as e:
+        print(f"Coverage analytics unavailable: {e}")
 
 async def seed_washroom_data():
     """Seed database with sample washroom data"""
@@ -176,6 +196,7 @@ async def get_nearest_washrooms(
                     },
                     "distanceField": "distance",
                     "maxDistance": radius,
+                    "query": {"duplicate_of": None},  # Hide records flagged as duplicates
                     "spherical": True
                 }
             }
@@ -211,6 +232,8 @@ async def get_nearest_washrooms(
                 "rating": washroom["rating"],
                 "hours": washroom["hours"],
                 "verified": washroom["verified"],
+                "duplicate_of": washroom.get("duplicate_of"),
+                "merged_into": washroom.get("merged_into"),
                 "created_at": washroom["created_at"],
                 "distance": round(washroom["distance"], 2)
             }
@@ -229,7 +252,8 @@ async def get_all_washrooms(
     """Get all washrooms with pagination"""
     
     try:
-        cursor = washrooms_collection.find().skip(skip).limit(limit)
+        # Records merged into another are only reachable by id
+        cursor = washrooms_collection.find({"merged_into": None}).skip(skip).limit(limit)
         washrooms = await cursor.to_list(length=limit)
         
         response_data = []
@@ -250,6 +274,8 @@ async def get_all_washrooms(
                 "rating": washroom["rating"],
                 "hours": washroom["hours"],
                 "verified": washroom["verified"],
+                "duplicate_of": washroom.get("duplicate_of"),
+                "merged_into": washroom.get("merged_into"),
                 "created_at": washroom["created_at"]
             }
             response_data.append(Washroom(**washroom_data))
@@ -274,13 +300,53 @@ async def add_washroom(washroom: Washroom):
             "type": "Point",
             "coordinates": [location["longitude"], location["latitude"]]  # GeoJSON is [lng, lat]
         }
+        washroom_data["duplicate_of"] = None
+        
+        # Merge into a nearby record describing the same facility, or flag a weaker match
+        duplicate = await find_duplicate(washrooms_collection, washroom_data)
+        if duplicate and duplicate.score >= merge_score():
+            existing = duplicate.washroom
+            # Accessibility claims from submissions are recorded, not trusted
+            updates = merge_updates(existing["id"], washroom_data, claims_accessibility(existing, washroom_data))
+            result = await washrooms_collection.bulk_write(updates, ordered=True) if updates else None
+            if result and result.modified_count:
+                existing = await washrooms_collection.find_one({"id": existing["id"]}) or existing
+                try:
+                    await coverage_store.apply_insert(existing)
+                except Exception as e:
+                    print(f"Coverage update error: {e}")
+            
+            coordinates = existing["location"]["coordinates"]
+            return Washroom(
+                id=existing["id"],
+                name=existing["name"],
+                location=Location(latitude=coordinates[1], longitude=coordinates[0]),  # GeoJSON is [lng, lat]
+                address=existing["address"],
+                description=existing["description"],
+                amenities=existing["amenities"],
+                accessibility=existing["accessibility"],
+                rating=existing["rating"],
+                hours=existing["hours"],
+                verified=existing["verified"],
+                created_at=existing["created_at"]
+            )
+        if duplicate:
+            washroom_data["duplicate_of"] = duplicate.washroom["id"]
+            washroom_data["duplicate_score"] = round(duplicate.score, 3)
         
         result = await washrooms_collection.insert_one(washroom_data)
         
         if result.inserted_id:
+            # Patch coverage analytics for cells the new washroom is closer to
+            try:
+                await coverage_store.apply_insert(washroom_data)
+            except Exception as e:
+                print(f"Coverage update error: {e}")
+            
             # Return the original format to frontend
             return_data = washroom.dict()
             return_data["id"] = washroom_data["id"]
+            return_data["duplicate_of"] = washroom_data["duplicate_of"]
             return_data["created_at"] = washroom_data["created_at"]
             return Washroom(**return_data)
         else:
@@ -289,6 +355,42 @@ async def add_washroom(washroom: Washroom):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating washroom: {str(e)}")
 
+@app.post("/api/washrooms/deduplicate")
+async def deduplicate_washrooms(
+    dry_run: bool = Query(True, description="Only report what would be merged or flagged"),
+    x_admin_key: Optional[str] = Header(None, description="Required when dry_run is false")
+):
+    """Find near-duplicate washrooms across the collection and merge or flag them"""
+    
+    # Applying the plan merges and hides records, so it needs the configured admin key
+    if not dry_run:
+        admin_key = os.getenv("ADMIN_API_KEY")
+        if not admin_key or not x_admin_key or not secrets.compare_digest(x_admin_key, admin_key):
+            raise HTTPException(status_code=403, detail="Admin key required to apply deduplication")
+    
+    try:
+        plan, applied = await run_deduplication(washrooms_collection, dry_run=dry_run)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error deduplicating washrooms: {str(e)}")
+    
+    # Merged, flagged and unflagged records change which washrooms count towards
+    # coverage, in ways that in-place patching cannot express
+    if not dry_run and (applied or plan.flags or plan.repoints):
+        try:
+            await coverage_store.rebuild()
+        except Exception as e:
+            print(f"Coverage rebuild error: {e}")
+    
+    return {
+        "dry_run": dry_run,
+        "merged": sum(len(merge["duplicates"]) for merge in plan.merges),
+        "flagged": len(plan.flags),
+        "repointed": len(plan.repoints),
+        "applied": applied,
+        "merges": plan.merges,
+        "flags": plan.flags
+    }
+
 @app.get("/api/washrooms/{washroom_id}", response_model=Washroom)
 async def get_washroom(washroom_id: str):
     """Get specific washroom by ID"""
@@ -315,6 +417,8 @@ async def get_washroom(washroom_id: str):
             "rating": washroom["rating"],
             "hours": washroom["hours"],
             "verified": washroom["verified"],
+            "duplicate_of": washroom.get("duplicate_of"),
+            "merged_into": washroom.get("merged_into"),
             "created_at": washroom["created_at"]
         }
         
@@ -325,6 +429,94 @@ async def get_washroom(washroom_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching washroom: {str(e)}")
 
+def coverage_filters(accessible: bool, verified: bool, open_24h: bool) -> List[str]:
+    filters = {"accessible": accessible, "verified": verified, "open_24h": open_24h}
+    return [name for name, enabled in filters.items() if enabled]
+
+def require_coverage():
+    if coverage_store.grid is None:
+        raise HTTPException(status_code=503, detail="Coverage analytics have not been computed yet")
+
+# The read-only coverage handlers below are numpy-heavy, so they are plain functions
+# that FastAPI runs in its threadpool rather than on the event loop
+@app.get("/api/analytics/coverage")
+def get_coverage_summary(
+    min_distance: int = Query(500, description="Distance in meters beyond which a cell counts as a service gap")
+):
+    """Summarize coverage for each filter combination"""
+    
+    require_coverage()
+    grid = coverage_store.grid
+    layers = {}
+    for key, layer in coverage_store.layers.items():
+        layers[key] = {
+            "gap_cells": int((layer >= min_distance).sum()),
+            "gap_fraction": round(float((layer >= min_distance).mean()), 4)
+        }
+    
+    return {
+        "grid": {
+            "min_latitude": grid.min_lat,
+            "min_longitude": grid.min_lng,
+            "rows": grid.rows,
+            "cols": grid.cols,
+            "cell_size": grid.cell_size
+        },
+        "computed_at": coverage_store.computed_at,
+        "min_distance": min_distance,
+        "layers": layers
+    }
+
+@app.post("/api/analytics/coverage/recompute")
+async def recompute_coverage():
+    """Recompute coverage analytics from the full washroom collection"""
+    
+    try:
+        await coverage_store.rebuild()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error computing coverage: {str(e)}")
+    
+    return {"status": "ok", "computed_at": coverage_store.computed_at}
+
+@app.get("/api/analytics/coverage/gaps")
+def get_coverage_gaps(
+    min_distance: int = Query(500, description="Return cells at least this many meters from a washroom"),
+    accessible: bool = Query(False, description="Only count accessible washrooms"),
+    verified: bool = Query(False, description="Only count verified washrooms"),
+    open_24h: bool = Query(False, description="Only count washrooms open 24/7"),
+    max_features: int = Query(10000, description="Maximum number of cells to return")
+):
+    """Service-gap cells as a GeoJSON FeatureCollection"""
+    
+    require_coverage()
+    layer = coverage_store.layer(coverage_filters(accessible, verified, open_24h))
+    try:
+        return gap_features(coverage_store.grid, layer, min_distance, max_features)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/analytics/coverage/tiles/{z}/{x}/{y}.png")
+def get_coverage_tile(
+    z: int,
+    x: int,
+    y: int,
+    max_distance: int = Query(1000, description="Distance in meters rendered as full red"),
+    accessible: bool = Query(False, description="Only count accessible washrooms"),
+    verified: bool = Query(False, description="Only count verified washrooms"),
+    open_24h: bool = Query(False, description="Only count washrooms open 24/7")
+):
+    """Coverage heatmap as a Web Mercator PNG tile"""
+    
+    require_coverage()
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z) or max_distance <= 0:
+        raise HTTPException(status_code=400, detail="Invalid tile coordinates")
+    
+    layer = coverage_store.layer(coverage_filters(accessible, verified, open_24h))
+    png = render_tile(coverage_store.grid, layer, z, x, y, max_distance)
+    return Response(content=png, media_type="image/png")
+
 @app.get("/api/maps/api-key")
 async def get_maps_api_key():
     """Get Google Maps API key for frontend"""
@@ -335,4 +527,11 @@ async def get_maps_api_key():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    # Trust X-Forwarded-For only from the ingress proxy, so rate limits apply per real client
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8001,
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+    )
\ No newline at end of file
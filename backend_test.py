@@ -7,6 +7,8 @@ Tests all backend endpoints comprehensively including geospatial functionality
 import requests
 import json
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Any
 import os
 from dotenv import load_dotenv
@@ -335,6 +337,239 @@ class BackendTester:
         except Exception as e:
             self.log_test("Missing Required Parameters", False, f"Error: {str(e)}")
     
+    def test_duplicate_submissions(self):
+        """Test POST /api/washrooms merge/flag/new outcomes and the batch dedup endpoint"""
+        print("\n=== Testing Duplicate Detection ===")
+        
+        # A unique name and spot (at least 55m from other runs) keep this test independent of earlier runs
+        tag = uuid.uuid4().hex[:8]
+        lat = 40.6892 + (int(tag, 16) % 500) * 0.0005
+        lng = -74.0445
+        original = {
+            "name": f"Dedup Kiosk {tag}",
+            "location": {"latitude": lat, "longitude": lng},
+            "address": f"{tag} Harbor Walk, New York, NY",
+            "description": "",
+            "amenities": ["hand_sanitizer"],
+            "accessibility": False,
+            "rating": 3.0,
+            "hours": "9:00 AM - 5:00 PM",
+            "verified": False
+        }
+        
+        try:
+            response = requests.post(f"{API_BASE}/washrooms", json=original, timeout=10)
+            created = response.json() if response.status_code == 200 else {}
+            if created.get("id") and created.get("duplicate_of") is None:
+                self.log_test("New Submission Stored", True, f"ID: {created['id']}")
+            else:
+                self.log_test("New Submission Stored", False, f"HTTP {response.status_code}: {response.text}")
+                return
+        except Exception as e:
+            self.log_test("New Submission Stored", False, f"Error: {str(e)}")
+            return
+        
+        # Same facility a few metres away: merged into the existing record, trust flags untouched
+        try:
+            duplicate = dict(original,
+                             name=f"Dedup Kiosk {tag} Restroom",
+                             location={"latitude": lat + 0.00002, "longitude": lng + 0.00002},
+                             description="Next to the ferry queue",
+                             amenities=["baby_changing"],
+                             accessibility=True,
+                             verified=True)
+            response = requests.post(f"{API_BASE}/washrooms", json=duplicate, timeout=10)
+            merged = response.json() if response.status_code == 200 else {}
+            if (merged.get("id") == created["id"] and not merged.get("verified")
+                    and not merged.get("accessibility")
+                    and set(merged.get("amenities", [])) == {"hand_sanitizer", "baby_changing"}):
+                self.log_test("Duplicate Submission Merged", True, "Merged without upgrading trust flags")
+            else:
+                self.log_test("Duplicate Submission Merged", False, f"HTTP {response.status_code}: {response.text}")
+        except Exception as e:
+            self.log_test("Duplicate Submission Merged", False, f"Error: {str(e)}")
+        
+        # Partially similar name nearby: stored, but flagged and hidden from nearest results
+        try:
+            similar = dict(original,
+                           name=f"Dedup Kiosk {tag} by the south ferry lawn",
+                           location={"latitude": lat + 0.00004, "longitude": lng - 0.00002})
+            response = requests.post(f"{API_BASE}/washrooms", json=similar, timeout=10)
+            flagged = response.json() if response.status_code == 200 else {}
+            if flagged.get("id") and flagged["id"] != created["id"] and flagged.get("duplicate_of") == created["id"]:
+                nearest = requests.get(f"{API_BASE}/washrooms/nearest",
+                                       params={"latitude": lat, "longitude": lng, "radius": 100},
+                                       timeout=10).json()
+                ids = [w["id"] for w in nearest]
+                if created["id"] in ids and flagged["id"] not in ids:
+                    self.log_test("Similar Submission Flagged", True, f"duplicate_of: {flagged['duplicate_of']}")
+                else:
+                    self.log_test("Similar Submission Flagged", False, f"Unexpected nearest results: {ids}")
+            else:
+                self.log_test("Similar Submission Flagged", False, f"HTTP {response.status_code}: {response.text}")
+        except Exception as e:
+            self.log_test("Similar Submission Flagged", False, f"Error: {str(e)}")
+        
+        try:
+            response = requests.post(f"{API_BASE}/washrooms/deduplicate", timeout=30)
+            data = response.json() if response.status_code == 200 else {}
+            if data.get("dry_run") is True and "merges" in data and "flags" in data:
+                self.log_test("Deduplication Dry Run", True, f"{data['merged']} merges, {data['flagged']} flags planned")
+            else:
+                self.log_test("Deduplication Dry Run", False, f"HTTP {response.status_code}: {response.text}")
+        except Exception as e:
+            self.log_test("Deduplication Dry Run", False, f"Error: {str(e)}")
+        
+        try:
+            response = requests.post(f"{API_BASE}/washrooms/deduplicate", params={"dry_run": False}, timeout=30)
+            if response.status_code == 403:
+                self.log_test("Deduplication Requires Admin Key", True, "Correctly returns 403")
+            else:
+                self.log_test("Deduplication Requires Admin Key", False, f"Expected 403, got {response.status_code}")
+        except Exception as e:
+            self.log_test("Deduplication Requires Admin Key", False, f"Error: {str(e)}")
+    
+    def test_coverage_analytics(self):
+        """Test coverage summary, gap GeoJSON, heatmap tiles and recompute"""
+        print("\n=== Testing Coverage Analytics ===")
+        
+        try:
+            response = requests.post(f"{API_BASE}/analytics/coverage/recompute", timeout=60)
+            if response.status_code == 200 and response.json().get("status") == "ok":
+                self.log_test("Coverage Recompute", True, f"Computed at {response.json().get('computed_at')}")
+            elif response.status_code == 503:
+                self.log_test("Coverage Recompute", True, "Recompute already running, shed with 503")
+            else:
+                self.log_test("Coverage Recompute", False, f"HTTP {response.status_code}: {response.text}")
+        except Exception as e:
+            self.log_test("Coverage Recompute", False, f"Error: {str(e)}")
+        
+        try:
+            response = requests.get(f"{API_BASE}/analytics/coverage", params={"min_distance": 500}, timeout=10)
+            if response.status_code == 200:
+                data = response.json()
+                grid = data.get("grid", {})
+                layers = data.get("layers", {})
+                if grid.get("rows") and grid.get("cols") and len(layers) == 8 and "all" in layers:
+                    self.log_test("Coverage Summary", True,
+                                  f"{grid['rows']}x{grid['cols']} grid, {layers['all']['gap_cells']} gap cells")
+                else:
+                    self.log_test("Coverage Summary", False, f"Invalid response format: {data}")
+            else:
+                self.log_test("Coverage Summary", False, f"HTTP {response.status_code}: {response.text}")
+        except Exception as e:
+            self.log_test("Coverage Summary", False, f"Error: {str(e)}")
+        
+        try:
+            response = requests.get(f"{API_BASE}/analytics/coverage/gaps",
+                                    params={"min_distance": 2000, "accessible": True}, timeout=10)
+            if response.status_code == 200:
+                data = response.json()
+                features = data.get("features", [])
+                valid = data.get("type") == "FeatureCollection" and all(
+                    f["geometry"]["type"] == "Polygon"
+                    and len(f["geometry"]["coordinates"][0]) == 5
+                    and (f["properties"]["distance"] is None or f["properties"]["distance"] >= 2000)
+                    for f in features
+                )
+                if valid:
+                    self.log_test("Coverage Gaps GeoJSON", True, f"{len(features)} gap cells beyond 2000m")
+                else:
+                    self.log_test("Coverage Gaps GeoJSON", False, "Invalid GeoJSON features")
+            elif response.status_code == 400:
+                self.log_test("Coverage Gaps GeoJSON", True, "Too many cells, correctly refused with 400")
+            else:
+                self.log_test("Coverage Gaps GeoJSON", False, f"HTTP {response.status_code}: {response.text}")
+        except Exception as e:
+            self.log_test("Coverage Gaps GeoJSON", False, f"Error: {str(e)}")
+        
+        # Zoom 12 tile over midtown Manhattan
+        try:
+            response = requests.get(f"{API_BASE}/analytics/coverage/tiles/12/1205/1539.png", timeout=10)
+            if (response.status_code == 200 and response.headers.get("content-type") == "image/png"
+                    and response.content[:8] == b"\x89PNG\r\n\x1a\n"):
+                self.log_test("Coverage Heatmap Tile", True, f"{len(response.content)} byte PNG")
+            else:
+                self.log_test("Coverage Heatmap Tile", False, f"HTTP {response.status_code}: {response.headers.get('content-type')}")
+        except Exception as e:
+            self.log_test("Coverage Heatmap Tile", False, f"Error: {str(e)}")
+        
+        try:
+            response = requests.get(f"{API_BASE}/analytics/coverage/tiles/2/9/0.png", timeout=10)
+            if response.status_code == 400:
+                self.log_test("Invalid Tile Coordinates", True, "Correctly returns 400")
+            else:
+                self.log_test("Invalid Tile Coordinates", False, f"Expected 400, got {response.status_code}")
+        except Exception as e:
+            self.log_test("Invalid Tile Coordinates", False, f"Error: {str(e)}")
+    
+    def test_admission_control(self):
+        """Test load shedding (503) and per-client rate limiting (429)"""
+        print("\n=== Testing Admission Control ===")
+        
+        # A deep page costs the whole list-route gate, so a concurrent one with no queueing budget is shed
+        try:
+            params = {"skip": 5000, "limit": 50}
+            headers = {"X-Request-Timeout-Ms": "0"}
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                responses = list(pool.map(
+                    lambda _: requests.get(f"{API_BASE}/washrooms", params=params, headers=headers, timeout=10),
+                    range(2)
+                ))
+            statuses = sorted(r.status_code for r in responses)
+            shed = [r for r in responses if r.status_code == 503]
+            
+            if shed and "Retry-After" in shed[0].headers:
+                self.log_test("Load Shedding (503)", True, f"Statuses: {statuses}, Retry-After: {shed[0].headers['Retry-After']}")
+            elif shed:
+                self.log_test("Load Shedding (503)", False, "503 response missing Retry-After header")
+            elif all(status in (200, 429) for status in statuses):
+                self.log_test("Load Shedding (503)", True, f"Gate not saturated in time, statuses: {statuses}")
+            else:
+                self.log_test("Load Shedding (503)", False, f"Unexpected statuses: {statuses}")
+        except Exception as e:
+            self.log_test("Load Shedding (503)", False, f"Error: {str(e)}")
+        
+        # Expensive searches drain the client's bucket quickly
+        try:
+            params = {"latitude": 40.7589, "longitude": -73.9851, "radius": 5000, "limit": 50}
+            limited = None
+            for _ in range(20):
+                response = requests.get(f"{API_BASE}/washrooms/nearest", params=params, timeout=10)
+                if response.status_code == 429:
+                    limited = response
+                    break
+            
+            if limited is not None and "Retry-After" in limited.headers:
+                self.log_test("Rate Limiting (429)", True, f"Retry-After: {limited.headers['Retry-After']}")
+            elif limited is not None:
+                self.log_test("Rate Limiting (429)", False, "429 response missing Retry-After header")
+            else:
+                self.log_test("Rate Limiting (429)", False, "No 429 after 20 expensive searches")
+        except Exception as e:
+            self.log_test("Rate Limiting (429)", False, f"Error: {str(e)}")
+        
+        # An unconfigured API key must not get a fresh bucket
+        try:
+            response = requests.get(f"{API_BASE}/washrooms/nearest", params=params,
+                                    headers={"X-API-Key": str(uuid.uuid4())}, timeout=10)
+            if response.status_code == 429:
+                self.log_test("Unknown API Key Rate Limited", True, "Random X-API-Key shares the IP bucket")
+            else:
+                self.log_test("Unknown API Key Rate Limited", False, f"Expected 429, got {response.status_code}")
+        except Exception as e:
+            self.log_test("Unknown API Key Rate Limited", False, f"Error: {str(e)}")
+        
+        # Health checks are never limited
+        try:
+            response = requests.get(f"{API_BASE}/health", timeout=10)
+            if response.status_code == 200:
+                self.log_test("Health Check Exempt", True, "Health check not rate limited")
+            else:
+                self.log_test("Health Check Exempt", False, f"HTTP {response.status_code}")
+        except Exception as e:
+            self.log_test("Health Check Exempt", False, f"Error: {str(e)}")
+    
     def run_all_tests(self):
         """Run all backend tests"""
         print("🧪 Starting LooLocator Backend API Tests")
@@ -352,6 +587,10 @@ class BackendTester:
         self.test_add_washroom()
         self.test_maps_api_key()
         self.test_data_validation()
+        self.test_duplicate_submissions()
+        self.test_coverage_analytics()
+        # Runs last: it deliberately exhausts this client's rate limit
+        self.test_admission_control()
         
         # Print summary
         print("\n" + "=" * 60)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The backend runs with PYTHONPATH=backend (see supervisord.conf); mirror that for tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
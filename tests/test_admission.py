@@ -0,0 +1,369 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+import admission
+from admission import (
+    AdmissionController,
+    InMemoryLimiterStore,
+    LimiterStore,
+    RoutePolicy,
+    WeightedGate,
+    list_cost,
+    nearest_cost,
+    tile_cost,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    # Replace the module's `time`, not time.monotonic itself, which asyncio's timers rely on
+    monkeypatch.setattr(admission, "time", SimpleNamespace(monotonic=fake))
+    return fake
+
+
+def make_request(path="/api/washrooms", method="GET", query=b"", headers=(), client="10.0.0.1"):
+    return Request({
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query,
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+        "client": (client, 12345),
+        "server": ("testserver", 80),
+        "scheme": "http",
+    })
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def settle():
+    """Let queued waiters (and wait_for's inner task) run up to their next await"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+# Token bucket
+def test_limiter_store_is_abstract():
+    with pytest.raises(TypeError):
+        LimiterStore()
+
+
+def test_bucket_allows_burst_then_reports_retry_after(clock):
+    store = InMemoryLimiterStore()
+
+    async def scenario():
+        allowed = [await store.consume("c", rate=2, burst=4, cost=1) for _ in range(4)]
+        denied = await store.consume("c", rate=2, burst=4, cost=3)
+        return allowed, denied
+
+    allowed, denied = run(scenario())
+    assert allowed == [0.0] * 4
+    # Empty bucket, 3 tokens needed at 2 tokens/s
+    assert denied == pytest.approx(1.5)
+
+
+def test_bucket_refills_over_time_up_to_burst(clock):
+    store = InMemoryLimiterStore()
+
+    async def scenario():
+        await store.consume("c", rate=2, burst=4, cost=4)
+        clock.now += 1.0
+        partial = await store.consume("c", rate=2, burst=4, cost=3)
+        clock.now += 100.0
+        full = await store.consume("c", rate=2, burst=4, cost=4)
+        over = await store.consume("c", rate=2, burst=4, cost=1)
+        return partial, full, over
+
+    partial, full, over = run(scenario())
+    assert partial == pytest.approx(0.5)
+    assert full == 0.0
+    assert over == pytest.approx(0.5)
+
+
+def test_buckets_are_per_key(clock):
+    store = InMemoryLimiterStore()
+
+    async def scenario():
+        await store.consume("a", rate=1, burst=1, cost=1)
+        return await store.consume("a", rate=1, burst=1, cost=1), await store.consume("b", rate=1, burst=1, cost=1)
+
+    assert run(scenario()) == (pytest.approx(1.0), 0.0)
+
+
+def test_prune_drops_only_full_buckets(clock):
+    store = InMemoryLimiterStore(max_keys=2)
+
+    async def scenario():
+        await store.consume("drained", rate=1, burst=5, cost=5)
+        clock.now += 10
+        await store.consume("refilled", rate=1, burst=5, cost=0)
+        await store.consume("busy", rate=1, burst=5, cost=5)
+
+    run(scenario())
+    assert set(store._buckets) == {"busy"}
+
+
+# Weighted gate
+def test_gate_admits_until_capacity_then_sheds_on_full_queue():
+    async def scenario():
+        gate = WeightedGate(capacity=2, max_queue=1)
+        assert await gate.acquire(1, timeout=1)
+        assert await gate.acquire(1, timeout=1)
+        waiter = asyncio.ensure_future(gate.acquire(1, timeout=1))
+        await settle()
+        assert not await gate.acquire(1, timeout=1)
+        gate.release(1)
+        assert await waiter
+        assert gate.in_use == 2
+
+    run(scenario())
+
+
+def test_gate_costs_are_clamped_to_capacity():
+    async def scenario():
+        gate = WeightedGate(capacity=2, max_queue=1)
+        assert await gate.acquire(50, timeout=0)
+        assert gate.in_use == 2
+        gate.release(50)
+        assert gate.in_use == 0
+
+    run(scenario())
+
+
+def test_gate_zero_deadline_does_not_queue():
+    async def scenario():
+        gate = WeightedGate(capacity=1, max_queue=5)
+        await gate.acquire(1, timeout=1)
+        assert not await gate.acquire(1, timeout=0)
+        assert len(gate._waiters) == 0
+
+    run(scenario())
+
+
+def test_gate_wakes_waiters_in_fifo_order():
+    async def scenario():
+        gate = WeightedGate(capacity=2, max_queue=5)
+        await gate.acquire(2, timeout=1)
+        order = []
+
+        async def waiter(name, cost):
+            await gate.acquire(cost, timeout=1)
+            order.append(name)
+
+        # The large waiter at the head blocks the small one behind it
+        tasks = [asyncio.ensure_future(waiter("large", 2)), asyncio.ensure_future(waiter("small", 1))]
+        await settle()
+        gate.release(1)
+        await settle()
+        assert order == []
+        gate.release(1)
+        await settle()
+        assert order == ["large"]
+        gate.release(2)
+        await asyncio.gather(*tasks)
+        assert order == ["large", "small"]
+
+    run(scenario())
+
+
+def test_gate_timeout_removes_waiter_and_unblocks_the_next():
+    async def scenario():
+        gate = WeightedGate(capacity=2, max_queue=5)
+        await gate.acquire(1, timeout=1)
+        blocked = asyncio.ensure_future(gate.acquire(2, timeout=0.01))
+        small = asyncio.ensure_future(gate.acquire(1, timeout=1))
+        assert not await blocked
+        # Once the head times out, the small waiter fits in the free unit
+        assert await small
+        assert gate.in_use == 2
+        assert len(gate._waiters) == 0
+
+    run(scenario())
+
+
+def test_gate_cancelled_waiter_is_removed():
+    async def scenario():
+        gate = WeightedGate(capacity=1, max_queue=5)
+        await gate.acquire(1, timeout=1)
+        waiter = asyncio.ensure_future(gate.acquire(1, timeout=1))
+        await settle()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert len(gate._waiters) == 0
+        gate.release(1)
+        assert gate.in_use == 0
+
+    run(scenario())
+
+
+def test_gate_grant_racing_the_deadline_returns_the_units():
+    async def granted_then_timed_out(future, timeout):
+        await future
+        raise asyncio.TimeoutError
+
+    async def scenario():
+        gate = WeightedGate(capacity=1, max_queue=5)
+        await gate.acquire(1, timeout=1)
+        gate._wait_for = granted_then_timed_out
+        late = asyncio.ensure_future(gate.acquire(1, timeout=1))
+        await settle()
+        gate.release(1)
+        assert not await late
+        assert gate.in_use == 0
+
+    run(scenario())
+
+
+def test_gate_cancellation_after_grant_leaves_no_leak():
+    async def scenario():
+        gate = WeightedGate(capacity=1, max_queue=5)
+        await gate.acquire(1, timeout=1)
+        waiter = asyncio.ensure_future(gate.acquire(1, timeout=1))
+        await settle()
+        gate.release(1)
+        waiter.cancel()
+        try:
+            acquired = await waiter
+        except asyncio.CancelledError:
+            acquired = False
+        assert gate.in_use == (1 if acquired else 0)
+
+    run(scenario())
+
+
+# Cost estimates
+def test_costs_scale_with_query_parameters():
+    assert nearest_cost(make_request("/api/washrooms/nearest")) == 1.0
+    assert nearest_cost(make_request("/api/washrooms/nearest", query=b"radius=5000&limit=20")) == 10.0
+    assert list_cost(make_request(query=b"skip=950&limit=50")) == 11.0
+    assert list_cost(make_request(query=b"skip=oops")) == 1.5
+
+
+# Controller
+def make_controller(rate=1.0, burst=2.0, capacity=1.0, max_wait=0.05, api_keys=frozenset()):
+    policy = RoutePolicy(capacity=capacity, max_queue=1, max_wait=max_wait)
+    return AdmissionController(
+        store=InMemoryLimiterStore(),
+        rate=rate,
+        burst=burst,
+        policies={("GET", "/api/washrooms"): policy},
+        default_policy=policy,
+        exempt_paths=("/api/health",),
+        api_keys=api_keys,
+    )
+
+
+async def ok(request):
+    return JSONResponse({"ok": True})
+
+
+def test_controller_returns_429_with_retry_after(clock):
+    controller = make_controller()
+
+    async def scenario():
+        return [await controller(make_request(), ok) for _ in range(3)]
+
+    responses = run(scenario())
+    assert [r.status_code for r in responses] == [200, 200, 429]
+    assert responses[2].headers["retry-after"] == "1"
+
+
+def test_controller_ignores_unknown_api_keys(clock):
+    controller = make_controller(api_keys=frozenset({"partner"}))
+
+    async def scenario():
+        statuses = []
+        for i in range(3):
+            response = await controller(make_request(headers=[("X-API-Key", f"random-{i}")]), ok)
+            statuses.append(response.status_code)
+        trusted = await controller(make_request(headers=[("X-API-Key", "partner")]), ok)
+        return statuses, trusted.status_code
+
+    statuses, trusted = run(scenario())
+    assert statuses == [200, 200, 429]
+    assert trusted == 200
+
+
+def test_controller_returns_503_when_gate_stays_busy(clock):
+    controller = make_controller(burst=10)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def slow(request):
+            await release.wait()
+            return JSONResponse({"ok": True})
+
+        first = asyncio.ensure_future(controller(make_request(client="10.0.0.2"), slow))
+        await settle()
+        shed = await controller(make_request(), ok)
+        release.set()
+        return shed, await first
+
+    shed, first = run(scenario())
+    assert shed.status_code == 503
+    assert "retry-after" in shed.headers
+    assert first.status_code == 200
+
+
+def test_controller_skips_exempt_and_non_api_paths(clock):
+    controller = make_controller(burst=1)
+
+    async def scenario():
+        return [
+            (await controller(make_request(path), ok)).status_code
+            for path in ["/api/health", "/api/health", "/", "/"]
+        ]
+
+    assert run(scenario()) == [200, 200, 200, 200]
+
+
+def test_prefix_policies_match_parameterized_paths():
+    tiles = RoutePolicy(capacity=4, max_queue=1, max_wait=1)
+    default = RoutePolicy(capacity=1, max_queue=1, max_wait=1)
+    controller = AdmissionController(
+        store=InMemoryLimiterStore(), rate=1, burst=1,
+        policies={("GET", "/api/analytics/coverage/tiles/*"): tiles},
+        default_policy=default,
+    )
+
+    route, policy = controller.route_for(make_request("/api/analytics/coverage/tiles/12/1205/1539.png"))
+    assert policy is tiles
+    assert controller.route_for(make_request("/api/analytics/coverage/tiles/1/0/0.png"))[0] == route
+    assert controller.route_for(make_request("/api/analytics/coverage/tiles/1/0/0.png", method="POST"))[1] is default
+    assert controller.route_for(make_request("/api/analytics/coverage"))[1] is default
+
+
+def test_bucket_is_charged_full_cost_beyond_gate_capacity(clock):
+    policy = RoutePolicy(capacity=1, max_queue=0, max_wait=0, cost=lambda request: 20.0)
+    controller = AdmissionController(
+        store=InMemoryLimiterStore(), rate=1, burst=40,
+        policies={("POST", "/api/analytics/coverage/recompute"): policy},
+        default_policy=policy,
+    )
+
+    async def scenario():
+        request = lambda: make_request("/api/analytics/coverage/recompute", method="POST")
+        return [(await controller(request(), ok)).status_code for _ in range(3)]
+
+    assert run(scenario()) == [200, 200, 429]
+
+
+def test_tiles_get_a_fractional_cost():
+    assert tile_cost(make_request("/api/analytics/coverage/tiles/1/0/0.png")) < 1
@@ -0,0 +1,353 @@
+import asyncio
+import struct
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import coverage_analytics
+from coverage_analytics import (
+    BAND_ROWS,
+    MAX_DISTANCE,
+    CoverageGrid,
+    CoverageStore,
+    all_layer_keys,
+    apply_insert,
+    build_layers,
+    gap_features,
+    layer_key,
+    nearest_distances,
+    render_tile,
+    washroom_points,
+)
+
+
+def washroom(lng, lat, accessibility=False, verified=False, hours="9-5"):
+    return {
+        "location": {"type": "Point", "coordinates": [lng, lat]},
+        "accessibility": accessibility,
+        "verified": verified,
+        "hours": hours,
+    }
+
+
+WASHROOMS = [
+    washroom(-73.968285, 40.785091, accessibility=True, verified=True),
+    washroom(-73.985130, 40.758896, verified=True, hours="24/7"),
+    washroom(-73.996900, 40.700292, accessibility=True),
+]
+
+
+@pytest.fixture
+def grid():
+    return CoverageGrid.from_bounds(40.69, -74.01, 40.80, -73.95, 200)
+
+
+def decode_png(data):
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    offset, chunks = 8, {}
+    while offset < len(data):
+        length, kind = struct.unpack(">I4s", data[offset:offset + 8])
+        body = data[offset + 8:offset + 8 + length]
+        (crc,) = struct.unpack(">I", data[offset + 8 + length:offset + 12 + length])
+        assert crc == zlib.crc32(kind + body)
+        chunks[kind] = chunks.get(kind, b"") + body
+        offset += 12 + length
+    width, height, depth, color, _, _, _ = struct.unpack(">IIBBBBB", chunks[b"IHDR"])
+    raw = np.frombuffer(zlib.decompress(chunks[b"IDAT"]), dtype=np.uint8).reshape(height, 1 + width * 4)
+    assert (raw[:, 0] == 0).all()
+    return width, height, depth, color, raw[:, 1:].reshape(height, width, 4)
+
+
+def test_layer_keys_cover_every_filter_combination():
+    keys = all_layer_keys()
+    assert len(keys) == 8 and len(set(keys)) == 8
+    assert layer_key([]) == "all"
+    assert layer_key(["verified", "accessible"]) == "accessible+verified"
+
+
+def test_grid_refuses_too_many_cells():
+    with pytest.raises(ValueError):
+        CoverageGrid.from_bounds(40, -75, 41, -73, 10)
+
+
+def test_nearest_distances_match_brute_force(grid):
+    lat, lng = washroom_points(WASHROOMS)
+    distances = nearest_distances(grid, lat, lng)
+
+    x, y = grid.project(lat, lng)
+    cell_x, cell_y = grid.cell_centres()
+    brute = np.min(np.hypot(cell_x[..., None] - x, cell_y[..., None] - y), axis=-1)
+    assert distances.shape == (grid.rows, grid.cols)
+    assert np.abs(distances.astype(float) - brute).max() <= 0.5
+
+
+def test_nearest_distances_without_points_saturate(grid):
+    empty = np.array([], dtype=float)
+    assert (nearest_distances(grid, empty, empty) == MAX_DISTANCE).all()
+
+
+def test_build_layers_applies_filters(grid):
+    layers = build_layers(grid, WASHROOMS)
+    assert set(layers) == set(all_layer_keys())
+    # Only the Times Square record is open 24/7 and none is accessible and 24/7
+    assert (layers["accessible+open_24h"] == MAX_DISTANCE).all()
+    assert (layers["all"] <= layers["accessible"]).all()
+    assert (layers["accessible"] <= layers["accessible+verified"]).all()
+
+
+@pytest.mark.parametrize("point", [
+    (-73.975, 40.77),   # Between existing washrooms
+    (-74.009, 40.691),  # Grid corner
+    (-73.90, 40.75),    # Outside the grid, still closer for some cells
+])
+def test_apply_insert_matches_full_rebuild(grid, point):
+    layers = build_layers(grid, WASHROOMS)
+    new = washroom(*point, accessibility=True)
+    expected = build_layers(grid, WASHROOMS + [new])
+
+    for key, layer in layers.items():
+        before = layer.copy()
+        if all(coverage_analytics.FILTERS[name](new) for name in key.split("+") if key != "all"):
+            span = apply_insert(grid, layer, point[1], point[0])
+            changed_rows = np.nonzero((before != layer).any(axis=1))[0]
+            if span is None:
+                assert len(changed_rows) == 0
+            else:
+                assert span[0] <= changed_rows.min() and changed_rows.max() < span[1]
+        assert np.array_equal(layer, expected[key]), key
+
+
+def test_apply_insert_on_covered_cell_changes_nothing(grid):
+    layer = np.zeros((grid.rows, grid.cols), dtype=np.uint16)
+    assert apply_insert(grid, layer, 40.75, -73.98) is None
+
+
+def test_render_tile_decodes_as_256_square_rgba(grid):
+    layers = build_layers(grid, WASHROOMS)
+    width, height, depth, color, pixels = decode_png(render_tile(grid, layers["all"], 12, 1205, 1539, 1000))
+    assert (width, height, depth, color) == (256, 256, 8, 6)
+    # The tile overlaps the grid, so some pixels are drawn and green/red never exceed 255 together
+    assert (pixels[..., 3] == 160).any()
+    assert (pixels[..., 0].astype(int) + pixels[..., 1] <= 256).all()
+
+
+def test_render_tile_outside_grid_is_transparent(grid):
+    layers = build_layers(grid, WASHROOMS)
+    _, _, _, _, pixels = decode_png(render_tile(grid, layers["all"], 12, 0, 0, 1000))
+    assert (pixels[..., 3] == 0).all()
+
+
+def test_gap_features_cell_bounds(grid):
+    layer = np.zeros((grid.rows, grid.cols), dtype=np.uint16)
+    layer[2, 3] = 750
+    layer[0, 0] = MAX_DISTANCE
+
+    collection = gap_features(grid, layer, 500, max_features=10)
+    features = {tuple(f["geometry"]["coordinates"][0][0]): f for f in collection["features"]}
+    assert len(features) == 2
+
+    south, west = grid.min_lat + 2 * grid.lat_step, grid.min_lng + 3 * grid.lng_step
+    ring = features[(west, south)]["geometry"]["coordinates"][0]
+    assert ring[0] == ring[-1]
+    assert ring[2] == pytest.approx([west + grid.lng_step, south + grid.lat_step])
+    # Cell edges are cell_size metres apart
+    assert (ring[2][1] - ring[0][1]) * coverage_analytics.METRES_PER_DEGREE == pytest.approx(grid.cell_size)
+    assert features[(west, south)]["properties"]["distance"] == 750
+    assert features[(grid.min_lng, grid.min_lat)]["properties"]["distance"] is None
+
+
+def test_gap_features_refuses_oversized_results(grid):
+    layer = np.full((grid.rows, grid.cols), 1000, dtype=np.uint16)
+    with pytest.raises(ValueError):
+        gap_features(grid, layer, 500, max_features=10)
+
+
+# Persistence, against a minimal in-memory stand-in for the Motor collection
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def __aiter__(self):
+        self._iter = iter(self.documents)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        return list(self.documents)
+
+
+class FakeCollection:
+    def __init__(self, documents=()):
+        self.documents = {str(i): dict(d, _id=str(i)) for i, d in enumerate(documents)}
+        self.writes = 0
+
+    def _matches(self, document, query):
+        for key, condition in query.items():
+            if isinstance(condition, dict):
+                if "$exists" in condition and (key in document) != condition["$exists"]:
+                    return False
+                if "$ne" in condition and document.get(key) == condition["$ne"]:
+                    return False
+            elif document.get(key) != condition:
+                return False
+        return True
+
+    def find(self, query=None, projection=None):
+        return FakeCursor([dict(d) for d in self.documents.values() if self._matches(d, query or {})])
+
+    async def find_one(self, query):
+        return next((dict(d) for d in self.documents.values() if self._matches(d, query)), None)
+
+    async def replace_one(self, query, document, upsert=False):
+        self.documents[query["_id"]] = dict(document, _id=query["_id"])
+        self.writes += 1
+
+    async def find_one_and_replace(self, query, document, upsert=False):
+        previous = self.documents.get(query["_id"])
+        await self.replace_one(query, document, upsert)
+        return previous
+
+    async def update_one(self, query, update):
+        document = next((d for d in self.documents.values() if self._matches(d, query)), None)
+        if document is None:
+            return SimpleNamespace(matched_count=0)
+        document.update(update.get("$set", {}))
+        for key, amount in update.get("$inc", {}).items():
+            document[key] = document.get(key, 0) + amount
+        self.writes += 1
+        return SimpleNamespace(matched_count=1)
+
+    async def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            await self.replace_one(request._filter, request._doc)
+
+    async def delete_many(self, query):
+        for key in [k for k, d in self.documents.items() if self._matches(d, query)]:
+            del self.documents[key]
+
+
+@pytest.fixture
+def env(monkeypatch):
+    monkeypatch.setenv("COVERAGE_BBOX", "40.69,-74.01,40.80,-73.95")
+    monkeypatch.setenv("COVERAGE_CELL_METRES", "20")
+    return monkeypatch
+
+
+def test_store_round_trips_through_bands(env):
+    washrooms, stored = FakeCollection(WASHROOMS), FakeCollection()
+
+    async def scenario():
+        first = CoverageStore(washrooms, stored)
+        await first.load_or_build()
+        second = CoverageStore(washrooms, stored)
+        await second.load_or_build()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first.grid.rows > BAND_ROWS
+    assert second.grid == first.grid and second.generation == first.generation
+    for key in all_layer_keys():
+        assert np.array_equal(first.layers[key], second.layers[key])
+
+
+def test_store_insert_rewrites_only_changed_bands(env):
+    washrooms, stored = FakeCollection(WASHROOMS), FakeCollection()
+    new = washroom(-73.975, 40.77, accessibility=True)
+
+    async def scenario():
+        store = CoverageStore(washrooms, stored)
+        await store.rebuild()
+        stored.writes = 0
+        changed = await store.apply_insert(new)
+        reloaded = CoverageStore(washrooms, stored)
+        await reloaded.load_or_build()
+        return store, changed, reloaded
+
+    store, changed, reloaded = asyncio.run(scenario())
+    bands = sum(np.ceil(hi / BAND_ROWS) - lo // BAND_ROWS for lo, hi in changed.values())
+    total_bands = len(all_layer_keys()) * np.ceil(store.grid.rows / BAND_ROWS)
+    assert set(changed) == {"all", "accessible"}
+    assert stored.writes == bands + 1 < total_bands
+    assert np.array_equal(reloaded.layers["accessible"], store.layers["accessible"])
+
+
+def test_store_rebuilds_when_configuration_changes(env):
+    washrooms, stored = FakeCollection(WASHROOMS), FakeCollection()
+
+    async def scenario():
+        await CoverageStore(washrooms, stored).load_or_build()
+        env.setenv("COVERAGE_CELL_METRES", "50")
+        store = CoverageStore(washrooms, stored)
+        await store.load_or_build()
+        return store
+
+    store = asyncio.run(scenario())
+    assert store.grid.cell_size == 50
+    # Bands from the previous generation are removed
+    generations = {d["generation"] for d in stored.documents.values() if "layer" in d}
+    assert generations == {store.generation}
+
+
+def test_store_rebuilds_when_bands_are_missing(env):
+    washrooms, stored = FakeCollection(WASHROOMS), FakeCollection()
+
+    async def scenario():
+        original = CoverageStore(washrooms, stored)
+        await original.load_or_build()
+        del stored.documents[f"{original.generation}:all:0"]
+        store = CoverageStore(washrooms, stored)
+        await store.load_or_build()
+        return original, store
+
+    original, store = asyncio.run(scenario())
+    assert store.generation != original.generation
+
+
+def test_store_merges_inserts_from_other_workers(env):
+    washrooms, stored = FakeCollection(WASHROOMS), FakeCollection()
+    east, west = washroom(-73.960, 40.775), washroom(-73.990, 40.775)
+
+    async def scenario():
+        first = CoverageStore(washrooms, stored)
+        await first.load_or_build()
+        second = CoverageStore(washrooms, stored)
+        await second.load_or_build()
+        await first.apply_insert(east)
+        await second.apply_insert(west)
+        reloaded = CoverageStore(washrooms, stored)
+        await reloaded.load_or_build()
+        return reloaded
+
+    reloaded = asyncio.run(scenario())
+    expected = build_layers(reloaded.grid, WASHROOMS + [east, west])
+    # The second worker's bands must not overwrite the first worker's insert
+    assert np.array_equal(reloaded.layers["all"], expected["all"])
+
+
+def test_stale_worker_reloads_instead_of_reviving_its_generation(env):
+    washrooms, stored = FakeCollection(WASHROOMS), FakeCollection()
+    new = washroom(-73.975, 40.77)
+
+    async def scenario():
+        stale = CoverageStore(washrooms, stored)
+        await stale.load_or_build()
+        old_generation = stale.generation
+        fresh = CoverageStore(washrooms, stored)
+        await fresh.rebuild()
+        await stale.apply_insert(new)
+        return stale, fresh, old_generation
+
+    stale, fresh, old_generation = asyncio.run(scenario())
+    meta = stored.documents["coverage"]
+    assert meta["current_generation"] == fresh.generation == stale.generation
+    generations = {d["generation"] for d in stored.documents.values() if "layer" in d}
+    assert generations == {fresh.generation} and old_generation not in generations
+    # The insert was re-applied to the current generation
+    assert np.array_equal(stale.layers["all"], build_layers(stale.grid, WASHROOMS + [new])["all"])
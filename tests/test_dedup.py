@@ -0,0 +1,179 @@
+import math
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from dedup import (
+    TextSignature,
+    claims_accessibility,
+    merge_updates,
+    normalize,
+    plan_deduplication,
+    similarity,
+)
+
+
+ORIGIN = (-73.968285, 40.785091)
+EPOCH = datetime(2024, 1, 1)
+
+
+def washroom(id, name, metres_east=0.0, address="Central Park, New York, NY", days=0, **extra):
+    """Record `metres_east` of ORIGIN, created `days` after EPOCH"""
+    lng = ORIGIN[0] + metres_east / (111_320 * math.cos(math.radians(ORIGIN[1])))
+    return dict({
+        "id": id,
+        "name": name,
+        "address": address,
+        "location": {"type": "Point", "coordinates": [lng, ORIGIN[1]]},
+        "created_at": EPOCH + timedelta(days=days),
+    }, **extra)
+
+
+def merged_ids(plan):
+    return {merge["canonical"]: sorted(merge["duplicates"]) for merge in plan.merges}
+
+
+def score(a, b):
+    return similarity(TextSignature.of({"name": a}), TextSignature.of({"name": b}))
+
+
+# Scoring
+def test_normalize_drops_generic_words_and_punctuation():
+    assert normalize("The Central-Park Public Restroom!") == "central park"
+    assert normalize(None) == ""
+
+
+def test_similarity_ignores_generic_words():
+    assert score("Central Park Restroom", "central park washroom") == 1.0
+    assert score("Central Park Restroom", "Hot Dog Stand") < 0.2
+
+
+def test_similarity_falls_back_when_a_field_is_empty():
+    a = TextSignature.of({"name": "Public Restroom", "address": "Pier 6"})
+    b = TextSignature.of({"name": "Washroom", "address": "Pier 6"})
+    assert similarity(a, b) == 1.0
+    assert similarity(TextSignature.of({}), TextSignature.of({})) == 0.0
+
+
+# Merging fields
+def test_merge_updates_fill_gaps_without_trust_flags():
+    incoming = {"amenities": ["baby_changing", "hand_sanitizer"], "description": "Near the lake",
+                "hours": "", "verified": True, "accessibility": True}
+    assert merge_updates("w1", incoming, accessibility_claimed=True) == [
+        UpdateOne({"id": "w1"}, {"$addToSet": {"amenities": {"$each": ["baby_changing", "hand_sanitizer"]}},
+                                 "$inc": {"accessibility_reports": 1}}),
+        UpdateOne({"id": "w1", "description": {"$in": [None, ""]}}, {"$set": {"description": "Near the lake"}}),
+    ]
+
+
+def test_merge_updates_skip_empty_submissions():
+    assert merge_updates("w1", {"amenities": [], "description": None}) == []
+
+
+def test_accessibility_claims_are_only_reported():
+    assert claims_accessibility({"accessibility": False}, {"accessibility": True})
+    assert not claims_accessibility({"accessibility": True}, {"accessibility": True})
+    assert not claims_accessibility({"accessibility": False}, {"accessibility": False})
+
+
+# Batch planning
+def test_distinct_or_distant_records_are_left_alone():
+    plan = plan_deduplication([
+        washroom("a", "Central Park Restroom"),
+        washroom("b", "Hot Dog Stand", metres_east=5),
+        washroom("c", "Central Park Restroom", metres_east=500),
+    ])
+    assert plan.merges == [] and plan.flags == [] and plan.repoints == []
+
+
+def test_chained_matches_only_merge_into_a_direct_match():
+    # a-b and b-c are within 25 m, a-c are not
+    plan = plan_deduplication([
+        washroom("a", "Central Park Restroom", days=0),
+        washroom("b", "Central Park Washroom", metres_east=15, days=1),
+        washroom("c", "Central Park Toilets", metres_east=30, days=3),
+    ])
+    assert merged_ids(plan) == {"a": ["b"]}
+    assert [(f["id"], f["duplicate_of"]) for f in plan.flags] == [("c", "a")]
+
+
+
+def test_verified_record_beats_older_unverified_one():
+    plan = plan_deduplication([
+        washroom("old", "Central Park Restroom", days=0),
+        washroom("verified", "Central Park Restroom", metres_east=3, days=5, verified=True),
+        washroom("newer", "Central Park Restroom", metres_east=6, days=9),
+    ])
+    assert merged_ids(plan) == {"verified": ["newer", "old"]}
+
+
+def test_oldest_record_wins_among_unverified():
+    plan = plan_deduplication([
+        washroom("newer", "Central Park Restroom", days=9),
+        washroom("old", "Central Park Restroom", metres_east=3, days=1),
+    ])
+    assert merged_ids(plan) == {"old": ["newer"]}
+
+
+def test_flagged_record_is_never_chosen_to_survive():
+    plan = plan_deduplication([
+        washroom("flagged", "Central Park Restroom", days=0, verified=True, duplicate_of="elsewhere"),
+        washroom("visible", "Central Park Restroom", metres_east=3, days=5),
+    ])
+    assert merged_ids(plan) == {"visible": ["flagged"]}
+
+
+def test_flags_pointing_at_merged_records_are_repointed():
+    plan = plan_deduplication([
+        washroom("keep", "Central Park Restroom", days=0),
+        washroom("gone", "Central Park Restroom", metres_east=3, days=1),
+        washroom("pointer", "Bethesda Terrace Restroom", metres_east=400, duplicate_of="gone"),
+    ])
+    assert merged_ids(plan) == {"keep": ["gone"]}
+    assert plan.repoints == [{"id": "pointer", "duplicate_of": "keep"}]
+
+
+def test_flag_pointing_into_its_own_group_is_cleared():
+    plan = plan_deduplication([
+        washroom("a", "Central Park Restroom", verified=True, duplicate_of="b"),
+        washroom("b", "Central Park Restroom", metres_east=3, duplicate_of="elsewhere"),
+    ])
+    assert merged_ids(plan) == {"a": ["b"]}
+    assert plan.repoints == [{"id": "a", "duplicate_of": None}]
+
+
+def test_weak_matches_are_flagged_against_the_preferred_record():
+    pair = [
+        washroom("older", "Central Park Restroom", days=0),
+        washroom("newer", "Central Park Restroom near the lake", metres_east=5, days=3),
+    ]
+    assert 0.5 <= similarity(TextSignature.of(pair[0]), TextSignature.of(pair[1])) < 0.8
+
+    plan = plan_deduplication(pair)
+    assert plan.merges == []
+    assert [(f["id"], f["duplicate_of"]) for f in plan.flags] == [("newer", "older")]
+
+
+def test_already_flagged_records_are_not_flagged_again():
+    plan = plan_deduplication([
+        washroom("older", "Central Park Restroom", days=0),
+        washroom("newer", "Central Park Restroom near the lake", metres_east=5, days=3, duplicate_of="x"),
+    ])
+    assert plan.flags == []
+
+
+def test_thresholds_are_read_from_the_environment_at_call_time(monkeypatch):
+    pair = [
+        washroom("older", "Central Park Restroom", days=0),
+        washroom("newer", "Central Park Restroom near the lake", metres_east=5, days=3),
+    ]
+    monkeypatch.setenv("DEDUP_MERGE_SCORE", "0.5")
+    assert merged_ids(plan_deduplication(pair)) == {"older": ["newer"]}
+
+    monkeypatch.setenv("DEDUP_RADIUS_METRES", "2")
+    assert plan_deduplication(pair).merges == []
+
+
+def test_single_record_needs_no_plan():
+    plan = plan_deduplication([washroom("a", "Central Park Restroom")])
+    assert plan.merges == [] and plan.flags == []